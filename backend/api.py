@@ -1,19 +1,23 @@
+import asyncio
+import io
 import os
-import shutil
-import json
-import soundfile
+import struct
+import aiofiles
+import numpy as np
+import orjson
 from fastapi import FastAPI, UploadFile, Form, File, HTTPException
 from fastapi.responses import FileResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from typing import Optional
 import uuid
+from pathlib import Path
 
 from corrector import Corrector
 from transcriber import Transcriber
 from voice_detector import VoiceDetector
 from video_processor import VideoProcessor
-from dependency_validator import validate_dependencies
+from dependency_validator import is_ffmpeg_available
 
 # Initialize app
 app = FastAPI()
@@ -32,6 +36,15 @@ OUT_DIR = "ephemeral"
 os.makedirs(OUT_DIR, exist_ok=True)
 app.mount("/results", StaticFiles(directory=OUT_DIR), name="results")
 
+# Size of each chunk read from an upload while streaming it to disk
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# Maximum number of Whisper requests in flight per transcription
+WHISPER_CONCURRENCY = int(os.getenv("WHISPER_CONCURRENCY", "5"))
+
+# 44-byte PCM16 mono WAV header for 16 kHz audio, only the sizes (and rate) vary per clip
+WAV_HEADER_TEMPLATE = struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 0, b'WAVE', b'fmt ', 16, 1, 1, 16000, 32000, 2, 16, b'data', 0)
+
 # Font configuration
 FONT_DIR = "/app/fonts"
 FONT_MAP = {
@@ -47,7 +60,6 @@ FONT_MAP = {
 
 # Initialize components
 try:
-    validate_dependencies()
     corrector = Corrector()
     transcriber = Transcriber()
     voice_detector = VoiceDetector()
@@ -65,17 +77,15 @@ async def get_fonts():
 def merge_whisper_transcripts(all_jsons):
     merged_segments = []
     texts = []
-    for (json_data, slice_start_sec, slice_end_sec) in all_jsons:
-        segs = json_data.get("segments", [])
-        for s in segs:
-            new_s = s.copy()
-            new_s["start"] = s["start"] + slice_start_sec
-            new_s["end"] = s["end"] + slice_start_sec
-            merged_segments.append(new_s)
-            texts.append(new_s["text"])
-    merged_segments.sort(key=lambda x: x["start"])
-    for i, seg in enumerate(merged_segments):
-        seg["id"] = i
+    # Clips don't overlap and Whisper segments are ordered within a clip, so ordering the clips orders the segments
+    for (json_data, slice_start_sec, slice_end_sec) in sorted(all_jsons, key=lambda item: item[1]):
+        # Segments are updated in place, the whisper responses are not used after merging
+        for s in json_data.get("segments", []):
+            s["id"] = len(merged_segments)
+            s["start"] += slice_start_sec
+            s["end"] += slice_start_sec
+            merged_segments.append(s)
+            texts.append(s["text"])
     merged = {
         "text": "".join(texts),
         "segments": merged_segments,
@@ -85,49 +95,62 @@ def merge_whisper_transcripts(all_jsons):
 
 def merge_vad_segments(vad_metadata, split_threshold=3.0):
     if not vad_metadata: return []
-    intervals = []
-    current_start = vad_metadata[0]["start"]
-    current_end = vad_metadata[0]["end"]
-    for seg in vad_metadata[1:]:
-        gap = seg["start"] - current_end
-        if gap <= split_threshold:
-            current_end = max(current_end, seg["end"])
-        else:
-            intervals.append((current_start, current_end))
-            current_start = seg["start"]
-            current_end = seg["end"]
-    intervals.append((current_start, current_end))
-    return intervals
-
-def refine_vad_intervals(path_to_audio: str, intervals, padding=0.1):
-    refined_intervals = []
-    for global_start, global_end in intervals:
-        vad_segments = voice_detector.get_audio_vad_metadata(path_to_audio, global_start * 1000, global_end * 1000)
-        if not vad_segments:
-            continue
-        local_start = vad_segments[0]["start"]
-        local_end = vad_segments[-1]["end"]
-        new_start = max(global_start, global_start + local_start - padding)
-        new_end = min(global_end, global_start + local_end + padding)
-        refined_intervals.append((new_start, new_end))
-    return refined_intervals
-
-def segment_audio_by_vad(path_to_audio: str, output_path, vad_metadata, refine=True):
-    file_name = os.path.basename(path_to_audio).split('.')[0]
-    intervals = merge_vad_segments(vad_metadata, split_threshold=3.0)
-    if refine:
-        intervals = refine_vad_intervals(path_to_audio, intervals)
-    
-    wav, sr = soundfile.read(path_to_audio)
-    slice_paths = []
+    starts = np.fromiter((seg["start"] for seg in vad_metadata), dtype=np.float64, count=len(vad_metadata))
+    ends = np.fromiter((seg["end"] for seg in vad_metadata), dtype=np.float64, count=len(vad_metadata))
+    running_ends = np.maximum.accumulate(ends)
+    breaks = np.flatnonzero(starts[1:] - running_ends[:-1] > split_threshold) + 1
+    interval_starts = starts[np.r_[0, breaks]]
+    interval_ends = running_ends[np.r_[breaks - 1, len(ends) - 1]]
+    return list(zip(interval_starts.tolist(), interval_ends.tolist()))
+
+def pcm16_wav_buffer(audio_slice, sr):
+    """Wraps mono float audio in a PCM16 WAV buffer, patching sizes and rate into the prebuilt header."""
+    pcm = np.rint(np.clip(audio_slice, -1.0, 1.0) * 32767).astype('<i2').tobytes()
+    buffer = bytearray(WAV_HEADER_TEMPLATE)
+    struct.pack_into('<I', buffer, 4, 36 + len(pcm))
+    struct.pack_into('<II', buffer, 24, sr, sr * 2)
+    struct.pack_into('<I', buffer, 40, len(pcm))
+    buffer += pcm
+    return io.BytesIO(buffer)
+
+async def produce_vad_clips(queue, path_to_audio: str, speech_segments, file_stem: str, num_consumers):
+    """Slices merged VAD intervals, queueing in-memory PCM16 WAV clips as soon as they are ready."""
+    wav, sr = await asyncio.to_thread(voice_detector._load_wav, path_to_audio)
+
+    def slice_intervals():
+        # Padded the way VAD would have padded them, from the one unpadded VAD run
+        vad_metadata = voice_detector.pad_speech_segments(speech_segments, len(wav) / sr)
+        return merge_vad_segments(vad_metadata, split_threshold=3.0)
+
+    intervals = await asyncio.to_thread(slice_intervals)
     for idx, (start_sec, end_sec) in enumerate(intervals):
-        start_sample = int(start_sec * sr)
-        end_sample = int(end_sec * sr)
-        audio_slice = wav[start_sample:end_sample]
-        out_path = f"{output_path}/{file_name}_slice_{idx:03d}.wav"
-        soundfile.write(out_path, audio_slice, sr)
-        slice_paths.append((out_path, start_sec, end_sec))
-    return slice_paths
+        # Encoded off the loop so the consumers' Whisper requests keep progressing meanwhile
+        buffer = await asyncio.to_thread(pcm16_wav_buffer, wav[int(start_sec * sr):int(end_sec * sr)], sr)
+        await queue.put(((f"{file_stem}_slice_{idx:03d}.wav", buffer), start_sec, end_sec))
+    for _ in range(num_consumers):
+        await queue.put(None)
+
+async def transcribe_vad_clips(path_to_audio: str, speech_segments, file_stem: str, prompt):
+    """Sends clips to Whisper while later ones are still being sliced."""
+    queue = asyncio.Queue(maxsize=2 * WHISPER_CONCURRENCY)
+    all_jsons = []
+
+    async def consume():
+        while (item := await queue.get()) is not None:
+            clip, start_sec, end_sec = item
+            result = await transcriber.get_audio_transcript(clip, prompt)
+            all_jsons.append((result, start_sec, end_sec))
+
+    tasks = [asyncio.create_task(consume()) for _ in range(WHISPER_CONCURRENCY)]
+    tasks.append(asyncio.create_task(produce_vad_clips(queue, path_to_audio, speech_segments, file_stem, WHISPER_CONCURRENCY)))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # Stop the rest of the pipeline if any stage failed
+        for task in tasks:
+            task.cancel()
+
+    return all_jsons
 
 @app.post("/transcribe")
 async def transcribe_video(
@@ -138,45 +161,54 @@ async def transcribe_video(
     post_processing: bool = Form(True),
     post_processing_prompt: Optional[str] = Form(None)
 ):
+    if not is_ffmpeg_available():
+        raise HTTPException(status_code=500, detail="FFmpeg is not installed or not in PATH")
+
     session_id = str(uuid.uuid4())
     session_dir = os.path.join(OUT_DIR, session_id)
-    os.makedirs(session_dir, exist_ok=True)
+    file_stem = Path(video.filename).stem
 
-    # Save uploaded video
+    # Every output location is derived once up front
     video_path = os.path.join(session_dir, video.filename)
-    with open(video_path, "wb") as buffer:
-        shutil.copyfileobj(video.file, buffer)
+    audio_file_path = os.path.join(session_dir, "sound", "audio.wav")
+    vocals_dir = os.path.join(session_dir, "vocals", "vocals.wav")
+    transcript_path = os.path.join(session_dir, "transcripts", "transcript.json")
+    final_video_path = os.path.join(session_dir, "result", "output.mkv")
+
+    for path in (audio_file_path, vocals_dir, transcript_path, final_video_path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # Save uploaded video, warming up VAD in the meantime
+
+    async def save_upload():
+        async with aiofiles.open(video_path, "wb") as buffer:
+            while chunk := await video.read(UPLOAD_CHUNK_SIZE):
+                await buffer.write(chunk)
 
     try:
+        await asyncio.gather(save_upload(), asyncio.to_thread(voice_detector.warmup))
+
         # 1. Separate Audio
-        audio_file_path = os.path.join(session_dir, "sound", "audio.wav")
-        os.makedirs(os.path.dirname(audio_file_path), exist_ok=True)
-        audio_path = video_processor.separate_audio_from_video(video_path, audio_file_path)
+        audio_path = await asyncio.to_thread(video_processor.separate_audio_from_video, video_path, audio_file_path)
 
         # 2. Separate Voice
-        vocals_dir = os.path.join(session_dir, "vocals", "vocals.wav")
-        os.makedirs(os.path.dirname(vocals_dir), exist_ok=True)
-        voice_path = voice_detector.separate_voice_from_audio(audio_path, vocals_dir)
-
-        # 3. VAD & Segmentation
-        md = voice_detector.get_audio_vad_metadata(voice_path)
-        clips_out_path = os.path.join(session_dir, "clips")
-        os.makedirs(clips_out_path, exist_ok=True)
-        clips_path = segment_audio_by_vad(voice_path, clips_out_path, md)
-
-        # 4. Transcribe
-        all_jsons = []
+        voice_path = await asyncio.to_thread(voice_detector.separate_voice_from_audio, audio_path, vocals_dir)
+
+        # 3. VAD (unpadded, the padded segments are derived from it when slicing)
+        speech_segments = await asyncio.to_thread(voice_detector.get_audio_vad_metadata, voice_path, speech_pad_ms=0)
+
+        # 4. Segment & Transcribe (pipelined, Whisper starts on the first clips while later ones are sliced)
         prompt = whisper_prompt if whisper_prompt else ""
-        for path, start_sec, end_sec in clips_path:
-            result = transcriber.get_audio_transcript(str(path), prompt)
-            all_jsons.append((result, start_sec, end_sec))
+        try:
+            all_jsons = await transcribe_vad_clips(voice_path, speech_segments, file_stem, prompt)
+        finally:
+            # The decoded audio isn't needed past slicing, don't keep it cached until the next upload
+            voice_detector.release_wav()
 
         final_json = merge_whisper_transcripts(all_jsons)
         
-        transcript_path = os.path.join(session_dir, "transcripts", "transcript.json")
-        os.makedirs(os.path.dirname(transcript_path), exist_ok=True)
-        with open(transcript_path, "w", encoding="utf8") as f:
-            json.dump(final_json, f, ensure_ascii=False, indent=2)
+        with open(transcript_path, "wb") as f:
+            f.write(orjson.dumps(final_json, option=orjson.OPT_INDENT_2))
 
         # 5. Post Processing
         final_transcript_path = transcript_path
@@ -184,24 +216,23 @@ async def transcribe_video(
             # Note: Corrector might need the prompt passed to it if it supports it
             # Assuming corrector.post_process_transcripts uses the prompt if available or default
             # The original code didn't pass the prompt to corrector, so we might need to update Corrector or just use default
-            corrected_segments = corrector.post_process_transcripts(final_json["segments"]) # TODO: Pass post_processing_prompt if supported
+            corrected_segments = await corrector.post_process_transcripts(final_json["segments"]) # TODO: Pass post_processing_prompt if supported
             
             base, ext = os.path.splitext(transcript_path)
             json_out_path = base + "_post" + ext
-            with open(json_out_path, "w", encoding="utf-8") as out:
-                json.dump(corrected_segments, out, ensure_ascii=False, indent=2)
+            with open(json_out_path, "wb") as out:
+                out.write(orjson.dumps(corrected_segments, option=orjson.OPT_INDENT_2))
             final_transcript_path = json_out_path
 
         # 6. Overlay Subtitles
-        final_video_path = os.path.join(session_dir, "result", "output.mkv")
-        os.makedirs(os.path.dirname(final_video_path), exist_ok=True)
-        
         # Get font path
         font_path = None
         if font and language in FONT_MAP and font in FONT_MAP[language]:
             font_path = FONT_MAP[language][font]
         
-        video_processor.overlay_transcription_subtitles(video_path, final_transcript_path, final_video_path, font_path)
+        # Burned in, the browser player doesn't show soft subtitle tracks and the font only applies when burning in
+        await asyncio.to_thread(video_processor.overlay_transcription_subtitles, video_path, final_transcript_path,
+                                final_video_path, font_path, burn_in=True)
 
         return {
             "status": "success",
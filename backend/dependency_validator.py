@@ -1,11 +1,23 @@
 import os
-import subprocess
+import shutil
 import sys
+from functools import lru_cache
 from typing import Tuple, List
 
 
+@lru_cache(maxsize=1)
+def is_ffmpeg_available() -> bool:
+    """
+    Check if FFmpeg is on the PATH. The lookup is cached, so repeated calls are free.
+
+    Returns:
+        bool: True if FFmpeg is available, False otherwise
+    """
+    return shutil.which('ffmpeg') is not None
+
+
 class DependencyValidator:
-    """Validates system and Python dependencies."""
+    """Validates system dependencies and environment configuration."""
 
     def __init__(self):
         self.errors: List[str] = []
@@ -18,34 +30,18 @@ class DependencyValidator:
         Returns:
             bool: True if FFmpeg is available, False otherwise
         """
-        try:
-            result = subprocess.run(
-                ['ffmpeg', '-version'],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                timeout=5
-            )
-            if result.returncode == 0:
-                print("✓ FFmpeg is installed")
-                return True
-            else:
-                self.errors.append("FFmpeg is installed but returned an error")
-                return False
-        except FileNotFoundError:
-            self.errors.append(
-                "FFmpeg is not installed or not in PATH.\n"
-                "  Please install FFmpeg:\n"
-                "  - Windows: Download from https://ffmpeg.org/download.html\n"
-                "  - Linux: sudo apt-get install ffmpeg\n"
-                "  - macOS: brew install ffmpeg"
-            )
-            return False
-        except subprocess.TimeoutExpired:
-            self.warnings.append("FFmpeg check timed out")
-            return False
-        except Exception as e:
-            self.errors.append(f"Error checking FFmpeg: {str(e)}")
-            return False
+        if is_ffmpeg_available():
+            print("✓ FFmpeg is installed")
+            return True
+
+        self.errors.append(
+            "FFmpeg is not installed or not in PATH.\n"
+            "  Please install FFmpeg:\n"
+            "  - Windows: Download from https://ffmpeg.org/download.html\n"
+            "  - Linux: sudo apt-get install ffmpeg\n"
+            "  - macOS: brew install ffmpeg"
+        )
+        return False
 
     def check_environment_variables(self) -> bool:
         """
@@ -74,36 +70,6 @@ class DependencyValidator:
         
         return all_set
 
-    def check_python_packages(self) -> bool:
-        """
-        Check if required Python packages are installed.
-        
-        Returns:
-            bool: True if all packages are available, False otherwise
-        """
-        required_packages = {
-            'torch': 'PyTorch',
-            'soundfile': 'soundfile',
-            'audio_separator': 'audio-separator',
-            'openai': 'openai',
-            'dotenv': 'python-dotenv',
-            'requests': 'requests'
-        }
-        
-        all_available = True
-        for module_name, package_name in required_packages.items():
-            try:
-                __import__(module_name)
-                print(f"✓ {package_name} is installed")
-            except ImportError:
-                self.errors.append(
-                    f"Python package '{package_name}' is not installed.\n"
-                    f"  Install with: pip install {package_name}"
-                )
-                all_available = False
-        
-        return all_available
-
     def validate_all(self) -> Tuple[bool, List[str], List[str]]:
         """
         Run all validation checks.
@@ -119,10 +85,7 @@ class DependencyValidator:
         env_ok = self.check_environment_variables()
         print()
         
-        packages_ok = self.check_python_packages()
-        print()
-        
-        success = ffmpeg_ok and env_ok and packages_ok
+        success = ffmpeg_ok and env_ok
         
         if success:
             print("All dependencies are satisfied!")
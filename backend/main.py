@@ -11,9 +11,13 @@ Attribution & Credits:
 - Video processing: FFmpeg (https://ffmpeg.org/)
 """
 
-import json
+import asyncio
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+import orjson
 import soundfile
 from dotenv import load_dotenv
 
@@ -25,29 +29,27 @@ from dependency_validator import validate_dependencies
 
 load_dotenv()
 OUT_DIR = "ephemeral"
+WHISPER_PROMPT = "本稿内容与《海绵宝宝》相关，涉及的词汇包括：海绵宝宝、派大星、章鱼哥、痞老板、蟹老板、蟹堡王、蟹黄堡、秘密配方、贝壳。"
+# Maximum number of Whisper requests in flight
+WHISPER_CONCURRENCY = int(os.getenv("WHISPER_CONCURRENCY", "5"))
 
 
 def merge_whisper_transcripts(all_jsons):
-    """Merges all related whisper requests into one transcript json"""
+    """Merges all related whisper requests into one transcript json. Segments are updated in place."""
 
     merged_segments = []
     texts = []
 
-    for (json_data, slice_start_sec, slice_end_sec) in all_jsons:
-        segs = json_data.get("segments", [])
+    # Clips don't overlap and Whisper segments are ordered within a clip,
+    # so ordering the clips is enough to order the merged segments
+    for (json_data, slice_start_sec, slice_end_sec) in sorted(all_jsons, key=lambda item: item[1]):
+        for s in json_data.get("segments", []):
+            s["id"] = len(merged_segments)
+            s["start"] += slice_start_sec
+            s["end"] += slice_start_sec
 
-        for s in segs:
-            new_s = s.copy()
-            new_s["start"] = s["start"] + slice_start_sec
-            new_s["end"] = s["end"] + slice_start_sec
-
-            merged_segments.append(new_s)
-            texts.append(new_s["text"])
-
-    merged_segments.sort(key=lambda x: x["start"])
-
-    for i, seg in enumerate(merged_segments):
-        seg["id"] = i
+            merged_segments.append(s)
+            texts.append(s["text"])
 
     merged = {
         "text": "".join(texts),
@@ -60,109 +62,98 @@ def merge_whisper_transcripts(all_jsons):
 def merge_vad_segments(vad_metadata, split_threshold=3.0):
     """Merges VAD segments that are within split_threshold seconds of each other."""
     if not vad_metadata:
-        return []   
-
-    intervals = []
-    current_start = vad_metadata[0]["start"]
-    current_end = vad_metadata[0]["end"]
-
-    for seg in vad_metadata[1:]:
-        gap = seg["start"] - current_end
-        if gap <= split_threshold:
-            current_end = max(current_end, seg["end"])
-        else:
-            intervals.append((current_start, current_end))
-            current_start = seg["start"]
-            current_end = seg["end"]
-
-    intervals.append((current_start, current_end))
-    return intervals
-
-
-def refine_vad_intervals(path_to_audio: str, intervals, padding=0.1):
-    """Second VAD pass to refine intervals by trimming leading/trailing silence."""
-    refined_intervals = []
-
-    for global_start, global_end in intervals:
-        vad_segments = voice_detector.get_audio_vad_metadata(path_to_audio, global_start * 1000, global_end * 1000)
+        return []
 
-        if not vad_segments:
-            print(f"No speech in interval {global_start:.2f}-{global_end:.2f}, skipping")
-            continue
+    starts = np.fromiter((seg["start"] for seg in vad_metadata), dtype=np.float64, count=len(vad_metadata))
+    ends = np.fromiter((seg["end"] for seg in vad_metadata), dtype=np.float64, count=len(vad_metadata))
 
-        local_start = vad_segments[0]["start"]
-        local_end = vad_segments[-1]["end"]
+    # The running max of the ends is the end of the interval being grown at each segment
+    running_ends = np.maximum.accumulate(ends)
+    breaks = np.flatnonzero(starts[1:] - running_ends[:-1] > split_threshold) + 1
 
-        new_start = max(global_start, global_start + local_start - padding)
-        new_end = min(global_end, global_start + local_end + padding)
+    interval_starts = starts[np.r_[0, breaks]]
+    interval_ends = running_ends[np.r_[breaks - 1, len(ends) - 1]]
 
-        trimmed_start = max(0, local_start - padding)
-        trimmed_end = (global_end - global_start) - local_end - padding
+    return list(zip(interval_starts.tolist(), interval_ends.tolist()))
 
-        if trimmed_start > 0.3 or trimmed_end > 0.3:
-            print(f"Refined {global_start:.2f}-{global_end:.2f} -> {new_start:.2f}-{new_end:.2f} "
-                  f"(trimmed {trimmed_start:.2f}s start, {max(0, trimmed_end):.2f}s end)")
 
-        refined_intervals.append((new_start, new_end))
+def write_clip(path_to_audio: str, out_path: str, start_sample: int, frames: int):
+    """Copies frames of an audio file into a PCM16 clip, reading only those frames as int16."""
+    # Each call opens its own handle, SoundFile objects are not safe to share between threads
+    with soundfile.SoundFile(path_to_audio) as f:
+        f.seek(start_sample)
+        audio_slice = f.read(frames, dtype='int16')
+        soundfile.write(out_path, audio_slice, f.samplerate, subtype='PCM_16')
 
-    return refined_intervals
 
+def segment_audio_by_vad(path_to_audio: str, output_path, speech_segments, file_stem: str):
+    """Pads and merges unpadded VAD segments into intervals, then slices audio into clips named after file_stem."""
+    info = soundfile.info(path_to_audio)
 
-def segment_audio_by_vad(path_to_audio: str, output_path, vad_metadata, refine=True):
-    """Uses VAD metadata to merge intervals, optionally refine, then slice audio into clips."""
-    file_name = path_to_audio.split('/')[-1].split('.')[0]
-
-    # First pass: merge nearby segments
+    # Merge nearby segments, padded the way VAD would have padded them
+    vad_metadata = voice_detector.pad_speech_segments(speech_segments, info.duration)
     intervals = merge_vad_segments(vad_metadata, split_threshold=3.0)
-    print(f"First pass: {len(intervals)} intervals")
-
-    # Second pass: refine each interval
-    if refine:
-        print("Running second VAD pass to refine intervals...")
-        intervals = refine_vad_intervals(path_to_audio, intervals)
-        print(f"After refinement: {len(intervals)} intervals")
+    print(f"Merged into {len(intervals)} intervals")
 
     print(intervals)
 
     # Create clips
-    wav, sr = soundfile.read(path_to_audio)
+    sr = info.samplerate
     slice_paths = []
+    jobs = []
 
     for idx, (start_sec, end_sec) in enumerate(intervals):
         start_sample = int(start_sec * sr)
         end_sample = int(end_sec * sr)
-        audio_slice = wav[start_sample:end_sample]
 
-        out_path = f"{output_path}/{file_name}_slice_{idx:03d}.wav"
-        soundfile.write(out_path, audio_slice, sr)
+        out_path = f"{output_path}/{file_stem}_slice_{idx:03d}.wav"
+        jobs.append((out_path, start_sample, end_sample - start_sample))
         slice_paths.append((out_path, start_sec, end_sec))
 
+    # Clips are independent read + write jobs, so run them in parallel
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(lambda job: write_clip(path_to_audio, *job), jobs))
+
     return slice_paths
 
 
-def main(video_processor, voice_detector, transcriber, corrector):
+async def main(video_processor, voice_detector, transcriber, corrector):
     video_path = "episodes/ported/17b_RockBottom.mkv"
-    file_name = f"{video_path.split("/")[-1].split(".")[0]}"
+    file_stem = Path(video_path).stem
+
+    # Every output location is derived from the stem once up front
+    run_dir = f"{OUT_DIR}/{file_stem}"
+    clips_out_path = f"{run_dir}/clips"
+    audio_file_path = f"{run_dir}/sound/{file_stem}_audio.wav"
+    vocals_dir = f"{run_dir}/vocals/{file_stem}_vocals.wav"
+    transcript_path = f"{run_dir}/transcripts/{file_stem}_transcripts.json"
+    final_video_path = f"{run_dir}/result/{file_stem}_with_subtitles.mkv"
+
+    for path in (audio_file_path, vocals_dir, transcript_path, final_video_path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.makedirs(clips_out_path, exist_ok=True)
 
-    audio_file_path = f"{OUT_DIR}/{file_name}/sound/{file_name}_audio.wav"
-    os.makedirs(os.path.dirname(audio_file_path), exist_ok=True)
     audio_path = video_processor.separate_audio_from_video(video_path, audio_file_path)
 
-    vocals_dir = f"{OUT_DIR}/{file_name}/vocals/{file_name}_vocals.wav"
-    os.makedirs(os.path.dirname(vocals_dir), exist_ok=True)
     voice_path = voice_detector.separate_voice_from_audio(audio_path, vocals_dir)
 
-    md = voice_detector.get_audio_vad_metadata(voice_path)
+    # One unpadded VAD pass, the padded segments are derived from it
+    speech_segments = voice_detector.get_audio_vad_metadata(voice_path, speech_pad_ms=0)
 
-    clips_out_path = f"{OUT_DIR}/{file_name}/clips"
-    os.makedirs(clips_out_path, exist_ok=True)
-    clips_path = segment_audio_by_vad(voice_path, clips_out_path, md)
+    clips_path = segment_audio_by_vad(voice_path, clips_out_path, speech_segments, file_stem)
 
     print("Transcribing the audio...")
+    # Whisper calls are network-bound and independent, keep up to WHISPER_CONCURRENCY in flight (gather keeps clip order)
+    sem = asyncio.Semaphore(WHISPER_CONCURRENCY)
+
+    async def transcribe_clip(path):
+        async with sem:
+            return await transcriber.get_audio_transcript(str(path), WHISPER_PROMPT)
+
+    results = await asyncio.gather(*(transcribe_clip(path) for path, _, _ in clips_path))
+
     all_jsons = []
-    for path, start_sec, end_sec in clips_path:
-        result = transcriber.get_audio_transcript(str(path),
-                                                  "本稿内容与《海绵宝宝》相关，涉及的词汇包括：海绵宝宝、派大星、章鱼哥、痞老板、蟹老板、蟹堡王、蟹黄堡、秘密配方、贝壳。")
+    for (path, start_sec, end_sec), result in zip(clips_path, results):
         # Add debug logging
         print(f"Clip {path}: offset={start_sec:.2f}s")
         for seg in result.get("segments", []):
@@ -172,25 +163,20 @@ def main(video_processor, voice_detector, transcriber, corrector):
 
     final_json = merge_whisper_transcripts(all_jsons)
 
-    transcript_path = f"{OUT_DIR}/{file_name}/transcripts/{file_name}_transcripts.json"
-    os.makedirs(os.path.dirname(transcript_path), exist_ok=True)
-
-    with open(transcript_path, "w", encoding="utf8") as f:
-        json.dump(final_json, f, ensure_ascii=False, indent=2)
+    with open(transcript_path, "wb") as f:
+        f.write(orjson.dumps(final_json, option=orjson.OPT_INDENT_2))
 
     print("Post processing the transcription...")
 
-    corrected_segments = corrector.post_process_transcripts(final_json["segments"])
+    corrected_segments = await corrector.post_process_transcripts(final_json["segments"])
 
     base, ext = os.path.splitext(transcript_path)
     json_out_path = base + "_post" + ext
 
-    with open(json_out_path, "w", encoding="utf-8") as out:
-        json.dump(corrected_segments, out, ensure_ascii=False, indent=2)
+    with open(json_out_path, "wb") as out:
+        out.write(orjson.dumps(corrected_segments, option=orjson.OPT_INDENT_2))
 
     print("Overlaying subtitles..")
-    final_video_path = f"{OUT_DIR}/{file_name}/result/{file_name}_with_subtitles.mkv"
-    os.makedirs(os.path.dirname(final_video_path), exist_ok=True)
     video_processor.overlay_transcription_subtitles(video_path, json_out_path, final_video_path)
 
 
@@ -216,4 +202,4 @@ if __name__ == "__main__":
         sys.exit(1)
     
     # Run main program
-    main(video_processor, voice_detector, transcriber, corrector)
+    asyncio.run(main(video_processor, voice_detector, transcriber, corrector))
@@ -1,8 +1,12 @@
+import asyncio
+import io
 import os
-import time
-from typing import Any
+import random
+from typing import Any, BinaryIO, Union
 
-from openai import OpenAI
+import aiofiles
+import httpx
+from openai import AsyncOpenAI, RateLimitError
 
 
 class Transcriber:
@@ -12,31 +16,60 @@ class Transcriber:
         if not open_ai_api_key:
             raise ValueError("Transcriber failed to initialize, api key is not set in environment.")
 
-        self.client = OpenAI(api_key=open_ai_api_key)
+        # Keep connections alive across clip uploads, concurrent requests share the pool over HTTP/2
+        limits = httpx.Limits(max_connections=64, max_keepalive_connections=64)
+        timeout = httpx.Timeout(120.0)
+        self.client = AsyncOpenAI(
+            api_key=open_ai_api_key,
+            http_client=httpx.AsyncClient(http2=True, limits=limits, timeout=timeout)
+        )
 
-    def get_audio_transcript(self, path_to_audio: str, prompt: str = None) -> dict[str, Any]:
-        """Gets the transcript for an audio file"""
+    async def get_audio_transcript(self, audio: Union[str, tuple[str, BinaryIO]], prompt: str = None) -> dict[str, Any]:
+        """
+        Gets the transcript for an audio file path or an in-memory (file name, WAV buffer) pair.
+        A coroutine, so many clips can be in flight without a thread each
+        """
 
+        if isinstance(audio, str):
+            async with aiofiles.open(audio, "rb") as f:
+                audio = (os.path.basename(audio), io.BytesIO(await f.read()))
+
+        name, buffer = audio
         max_retries = 3
-        retry_delay = 2
 
         for attempt in range(max_retries):
             try:
-                with open(path_to_audio, "rb") as f:
-                    resp = self.client.audio.transcriptions.create(
-                        model="whisper-1",
-                        file=f,
-                        response_format="verbose_json",
-                        timestamp_granularities=["segment"],
-                        language="zh",
-                        prompt=prompt
-                    )
+                buffer.seek(0)
+                resp = await self.client.audio.transcriptions.create(
+                    **self._transcription_params((name, buffer, "audio/wav"), prompt))
                 return resp.model_dump()
             except Exception as e:
                 print(f"OpenAI Whisper attempt {attempt + 1} failed: {e}")
                 if attempt < max_retries - 1:
-                    time.sleep(retry_delay)
+                    await asyncio.sleep(self._retry_delay(attempt, e))
                 else:
                     raise e
 
+    def _retry_delay(self, attempt: int, error: Exception) -> float:
+        """Exponential backoff with jitter so concurrent clips don't retry in lockstep, honoring Retry-After on rate limits"""
+
+        delay = 2 ** attempt
+        if isinstance(error, RateLimitError):
+            retry_after = error.response.headers.get("retry-after")
+            try:
+                delay = float(retry_after)
+            except (TypeError, ValueError):
+                pass
+
+        # A large Retry-After gets the same cap as the backoff, so one header can't park the whole request
+        return min(60, delay) + random.uniform(0, 1)
 
+    def _transcription_params(self, file, prompt: str = None) -> dict[str, Any]:
+        return dict(
+            model="whisper-1",
+            file=file,
+            response_format="verbose_json",
+            timestamp_granularities=["segment"],
+            language="zh",
+            prompt=prompt
+        )
@@ -1,14 +1,48 @@
-import json
 import os
 import subprocess
+import tempfile
+from functools import lru_cache
+
+import numpy as np
+import orjson
+
+# Burn-in encoder settings. Frames are decoded on the GPU for NVENC but not kept there,
+# since the subtitles filter runs on the CPU
+NVENC_DECODE_ARGS = ['-hwaccel', 'cuda']
+NVENC_ENCODE_ARGS = ['-c:v', 'h264_nvenc', '-preset', 'p1', '-cq', '23', '-b:v', '0']
+X264_ENCODE_ARGS = ['-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '23']
+
+
+@lru_cache(maxsize=1)
+def is_nvenc_available() -> bool:
+    """
+    Check if FFmpeg can encode H.264 on an NVIDIA GPU, by encoding a few blank frames with the burn-in settings.
+    Listing the encoder isn't enough, builds ship h264_nvenc without a GPU. The probe is cached.
+    """
+    try:
+        result = subprocess.run([
+            'ffmpeg', '-hide_banner', '-loglevel', 'error',
+            *NVENC_DECODE_ARGS,
+            '-f', 'lavfi', '-i', 'color=black:s=256x256:d=0.1',
+            *NVENC_ENCODE_ARGS,
+            '-f', 'null', '-'
+        ], capture_output=True, timeout=30)
+    except (FileNotFoundError, subprocess.TimeoutExpired):
+        return False
+
+    return result.returncode == 0
 
 
 class VideoProcessor:
     def __init__(self):
         pass
 
-    def overlay_transcription_subtitles(self, path_to_video, path_to_transcription_json, output_path, font_path=None):
-        """Overlays the subtitles from the transcript json on the video"""
+    def overlay_transcription_subtitles(self, path_to_video, path_to_transcription_json, output_path, font_path=None,
+                                        burn_in=False):
+        """
+        Overlays the subtitles from the transcript json on the video
+        By default they are muxed in as a soft subtitle track, burn_in draws them into the frames (requires a re-encode)
+        """
 
         if not os.path.exists(path_to_video):
             print(f"Error: Video file not found: {path_to_video}")
@@ -17,17 +51,72 @@ class VideoProcessor:
             print(f"Error: JSON file not found: {path_to_transcription_json}")
             return
 
-        # Create a temporary SRT file
-        srt_path = "temp_subtitles.srt"
         print(f"Converting {path_to_transcription_json} to SRT format...")
-        self._json_to_srt(path_to_transcription_json, srt_path)
+        srt = self._json_to_srt(path_to_transcription_json)
+
+        # The subtitles filter can only read from a file, soft subs are piped to ffmpeg's stdin instead
+        srt_path = None
+        if burn_in:
+            # One file per call next to the output, so concurrent overlays never share it
+            fd, srt_path = tempfile.mkstemp(suffix='.srt', dir=os.path.dirname(output_path) or None)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(srt)
+            # NVENC first when the probe passed, libx264 as the fallback if the real encode still fails
+            commands = []
+            if is_nvenc_available():
+                commands.append(self._burn_in_command(path_to_video, srt_path, output_path, font_path, nvenc=True))
+            commands.append(self._burn_in_command(path_to_video, srt_path, output_path, font_path, nvenc=False))
+            srt_input = None
+        else:
+            commands = [self._soft_subs_command(path_to_video, output_path)]
+            srt_input = srt.encode('utf-8')
 
-        # FFmpeg command to burn subtitles
-        # Using -preset ultrafast for speed as requested
-        # Using -y to overwrite output file if it exists
-        # Note: 'subtitles' filter requires the path to be escaped properly on Windows if it contains special chars,
-        # but for a simple filename in the current dir, it's fine.
-        # We use forward slashes for paths in ffmpeg filter to be safe or just relative path.
+        print(f"Running FFmpeg to overlay subtitles...")
+
+        try:
+            for attempt, cmd in enumerate(commands, start=1):
+                print(" ".join(cmd))
+                try:
+                    subprocess.run(cmd, input=srt_input, check=True)
+                    break
+                except subprocess.CalledProcessError as e:
+                    if attempt == len(commands):
+                        raise
+                    print(f"NVENC encode failed ({e}), retrying with libx264...")
+            print(f"Successfully created {output_path}")
+        except subprocess.CalledProcessError as e:
+            print(f"Error running FFmpeg: {e}")
+        except FileNotFoundError:
+            print("Error: FFmpeg not found. Please ensure FFmpeg is installed and in your PATH.")
+        finally:
+            if srt_path is not None:
+                os.remove(srt_path)
+
+    def _soft_subs_command(self, path_to_video, output_path):
+        """Muxes the SRT from stdin in as a subtitle track, video and audio are stream copied so nothing is re-encoded"""
+
+        # mp4/mov containers only take mov_text subtitles
+        subtitle_codec = 'mov_text' if output_path.lower().endswith(('.mp4', '.m4v', '.mov')) else 'srt'
+
+        return [
+            'ffmpeg',
+            '-y',
+            '-i', path_to_video,
+            '-f', 'srt',
+            '-i', 'pipe:0',
+            '-map', '0:v',
+            '-map', '0:a?',
+            '-map', '1',
+            '-c', 'copy',
+            '-c:s', subtitle_codec,
+            output_path
+        ]
+
+    def _burn_in_command(self, path_to_video, srt_path, output_path, font_path=None, nvenc=False):
+        """Draws the subtitles into the video frames, this re-encodes the whole video"""
+
+        # Note: 'subtitles' filter requires the path to be escaped properly on Windows if it contains special chars.
+        # We use forward slashes for paths in ffmpeg filter to be safe.
 
         # Escape backslashes for Windows ffmpeg filter
         srt_path_escaped = srt_path.replace('\\', '/').replace(':', '\\:')
@@ -40,30 +129,22 @@ class VideoProcessor:
         else:
             subtitles_filter = f"subtitles='{srt_path_escaped}'"
 
-        cmd = [
+        # Encode on the GPU with NVENC, otherwise libx264 with -preset ultrafast for speed
+        decode_args = NVENC_DECODE_ARGS if nvenc else []
+        encode_args = NVENC_ENCODE_ARGS if nvenc else X264_ENCODE_ARGS
+
+        # Audio is copied as is
+        return [
             'ffmpeg',
             '-y',
+            *decode_args,
             '-i', path_to_video,
             '-vf', subtitles_filter,
+            *encode_args,
             '-c:a', 'copy',
-            '-preset', 'ultrafast',
             output_path
         ]
 
-        print(f"Running FFmpeg to overlay subtitles...")
-        print(" ".join(cmd))
-
-        try:
-            subprocess.run(cmd, check=True)
-            print(f"Successfully created {output_path}")
-        except subprocess.CalledProcessError as e:
-            print(f"Error running FFmpeg: {e}")
-        except FileNotFoundError:
-            print("Error: FFmpeg not found. Please ensure FFmpeg is installed and in your PATH.")
-        finally:
-            if os.path.exists(srt_path):
-                os.remove(srt_path)
-
     def separate_audio_from_video(self, path_to_video: str, output_path):
         """
         Converts a video file to audio file
@@ -72,44 +153,51 @@ class VideoProcessor:
         subprocess.run([
             "ffmpeg",
             "-y",  # overwrite output
+            "-threads", "0",  # let ffmpeg pick the thread count
             "-i", path_to_video,
+            "-map", "0:a:0",  # first audio stream only, video and other streams are never decoded
             "-ac", "1",  # mono
             "-ar", "16000",  # 16 kHz (good for speech + Silero)
-            "-vn",  # no video
             output_path
         ])
 
         return output_path
 
-    def _json_to_srt(self, path_to_json, srt_path):
-        """Formats transcript json to use correct timestamps"""
+    def _json_to_srt(self, path_to_json):
+        """Formats transcript json as SRT text with correct timestamps"""
 
-        with open(path_to_json, 'r', encoding='utf-8') as f:
-            segments = json.load(f)
+        with open(path_to_json, 'rb') as f:
+            segments = orjson.loads(f.read())
 
         print(segments)
 
-        with open(srt_path, 'w', encoding='utf-8') as f:
-            for i, segment in enumerate(segments, start=1):
-                start = segment.get('start', 0)
-                end = segment.get('end', 0)
-                text = segment.get('text', '').strip()
+        cues = []
+        for i, segment in enumerate(segments, start=1):
+            text = segment.get('text', '').strip()
+
+            if not text:
+                continue
+
+            cues.append((i, segment.get('start', 0), segment.get('end', 0), text))
 
-                if not text:
-                    continue
+        # Every start and end timestamp is formatted in one vectorized pass, then the SRT is joined once
+        times = np.array([(start, end) for _, start, end, _ in cues], dtype=np.float64).reshape(-1)
+        stamps = self._format_timestamps(times)
 
-                f.write(f"{i}\n")
-                f.write(f"{self._format_timestamp(start)} --> {self._format_timestamp(end)}\n")
-                f.write(f"{text}\n\n")
+        return "".join(
+            f"{i}\n{stamps[2 * n]} --> {stamps[2 * n + 1]}\n{text}\n\n"
+            for n, (i, _, _, text) in enumerate(cues)
+        )
 
-    def _format_timestamp(self, seconds):
-        """Converts seconds to SRT timestamp format (HH:MM:SS,mmm)."""
+    def _format_timestamps(self, seconds):
+        """Converts an array of seconds to SRT timestamp format (HH:MM:SS,mmm)."""
 
-        total_seconds = int(seconds)
-        milliseconds = int((seconds - total_seconds) * 1000)
+        total_seconds = seconds.astype(np.int64)
+        milliseconds = ((seconds - total_seconds) * 1000).astype(np.int64)
 
         hours = total_seconds // 3600
         minutes = (total_seconds % 3600) // 60
         secs = total_seconds % 60
 
-        return f"{hours:02}:{minutes:02}:{secs:02},{milliseconds:03}"
+        return [f"{h:02}:{m:02}:{s:02},{ms:03}" for h, m, s, ms in
+                zip(hours.tolist(), minutes.tolist(), secs.tolist(), milliseconds.tolist())]
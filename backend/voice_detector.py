@@ -1,37 +1,120 @@
 import os
+import subprocess
+import threading
 from typing import Any
 
+import numpy as np
 import soundfile
 import torch
 from audio_separator.separator import Separator
 
+# Voice separation always runs on audio longer than 30s, set VOICE_SEP_FORCE=0 to skip it for speech-dominant audio
+VOICE_SEP_FORCE = os.getenv("VOICE_SEP_FORCE", "1") == "1"
+# Estimated SNR (dB) above which audio is treated as speech-dominant
+SPEECH_DOMINANCE_SNR_DB = float(os.getenv("SPEECH_DOMINANCE_SNR_DB", "20"))
+# Frames quieter than -60 dBFS are digital silence (title cards, act breaks), not a background floor
+SILENCE_RMS = 10 ** (-60 / 20)
+# Set VAD_INT8=1 to run Silero VAD with dynamically quantized INT8 linear layers
+VAD_INT8 = os.getenv("VAD_INT8") == "1"
+# Device Silero VAD runs on. CPU by default, Silero steps through 32 ms windows one forward call (and one
+# host sync) at a time, so CUDA rarely pays off and would compete with the separator for the GPU
+VAD_DEVICE = os.getenv("VAD_DEVICE") or "cpu"
+# Padding Silero adds around detected speech by default
+SPEECH_PAD_MS = 1000
+
 
 class VoiceDetector:
     def __init__(self):
-        pass
+        # Use every core for inference and flush denormals, which are slow on CPU and don't affect VAD results
+        torch.set_num_threads(os.cpu_count() or 1)
+        torch.set_flush_denormal(True)
+        # Silero runs its windows sequentially, extra inter-op threads would only contend with the intra-op pool
+        try:
+            torch.set_num_interop_threads(2)
+        except RuntimeError:
+            # Already set, or parallel work has started in this process
+            pass
+
+        # Load Silero VAD once and reuse it for every call
+        self.vad_model, vad_utils = torch.hub.load(
+            repo_or_dir='snakers4/silero-vad',
+            model='silero_vad',
+            force_reload=False,
+            trust_repo=True
+        )
+        self.vad_model.eval()
+        # Dynamic quantization only has CPU kernels
+        if VAD_INT8 and VAD_DEVICE == "cpu":
+            self.vad_model = self._quantize_vad_model(self.vad_model)
+        self.vad_model.to(VAD_DEVICE)
+        self.get_speech_timestamps = vad_utils[0]
+
+        # Silero keeps recurrent state between chunks, so only one thread may run it at a time
+        self._vad_lock = threading.Lock()
+
+        # Decoded audio of the most recently read file, keyed by (path, mtime)
+        self._wav_cache = {}
+        self._warmed_up = False
+
+    def warmup(self):
+        """Runs VAD once on silence so the first real call doesn't pay for lazy initialization."""
+
+        if not self._warmed_up:
+            self._run_vad_on_array(np.zeros(16000, dtype=np.float32), 16000)
+            self._warmed_up = True
+
+    def _quantize_vad_model(self, model):
+        """
+        Quantizes the linear layers of the VAD model to INT8, keeping the FP32 model if that isn't supported.
+        The hub model is TorchScript, which eager quantize_dynamic leaves untouched, so it goes through the JIT pass.
+        """
+
+        try:
+            if isinstance(model, torch.jit.ScriptModule):
+                quantized = torch.ao.quantization.quantize_dynamic_jit(
+                    model, {'': torch.ao.quantization.default_dynamic_qconfig})
+                changed = 'quantized::' in str(quantized.inlined_graph)
+            else:
+                quantized = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+                changed = any(type(old) is not type(new) for old, new in zip(model.modules(), quantized.modules()))
+
+            if not changed:
+                print("INT8 quantization found no layers to quantize in the VAD model, using FP32")
+                return model
+
+            # Make sure the quantized model still runs and kept the state reset get_speech_timestamps relies on
+            with torch.inference_mode():
+                quantized(torch.zeros(1, 512), 16000)
+            if hasattr(model, "reset_states"):
+                quantized.reset_states()
+        except Exception as e:
+            print(f"INT8 quantization of the VAD model failed, using FP32: {e}")
+            return model
+
+        print("VAD model quantized to INT8")
+        return quantized
 
     def separate_voice_from_audio(self, path_to_audio: str, output_path: str):
-        """Separates voice from other elements in an audio file. Skips separation for short clips (<30s)."""
+        """
+        Separates voice from other elements in an audio file, the directory of output_path must already exist.
+        Skips separation for short clips (<30s) and for audio that is already speech-dominant.
+        """
 
         out_dir = os.path.dirname(output_path)
         out_name = os.path.splitext(os.path.basename(output_path))[0]
 
-        os.makedirs(out_dir, exist_ok=True)
-
-        # Read audio to check length
-        wav, sr = soundfile.read(path_to_audio)
-        audio_duration_sec = len(wav) / sr
+        # Only the header is needed to check the length
+        audio_duration_sec = soundfile.info(path_to_audio).duration
         
         # Skip separation for short audio clips
         if audio_duration_sec < 30:
             print(f"Audio is {audio_duration_sec:.1f}s (< 30s). Skipping voice separation, using original audio.")
-            result_path = os.path.join(out_dir, out_name + ".wav")
-            
-            # Convert to mono if needed
-            if wav.ndim == 2:
-                wav = wav.mean(axis=1)
-            soundfile.write(result_path, wav, sr)
-            return result_path
+            return self._passthrough_audio(path_to_audio, os.path.join(out_dir, out_name + ".wav"))
+
+        # Skip separation when there is little background to remove
+        if not VOICE_SEP_FORCE and self._is_speech_dominant(path_to_audio):
+            print("Audio is speech-dominant. Skipping voice separation, using original audio.")
+            return self._passthrough_audio(path_to_audio, os.path.join(out_dir, out_name + ".wav"))
 
         print("Separating vocals... (This may take a while)")
 
@@ -47,17 +130,77 @@ class VoiceDetector:
         result_path = os.path.join(out_dir, output_files[0])
 
         # Convert to mono if needed
-        wav, sr = soundfile.read(result_path)
-        if wav.ndim == 2:
-            wav = wav.mean(axis=1)
-            soundfile.write(result_path, wav, sr)
+        if soundfile.info(result_path).channels > 1:
+            self._downmix_with_ffmpeg(result_path)
 
         return result_path
 
-    def get_audio_vad_metadata(self, path_to_audio: str, start_ms: int = 0, end_ms: int = float('inf')) -> list[dict[str, Any]]:
-        """Creates metadata for start and end times of voices."""
+    def _passthrough_audio(self, path_to_audio: str, output_path: str):
+        """Returns the original audio when it is already mono, otherwise a mono copy at output_path."""
+
+        if soundfile.info(path_to_audio).channels == 1:
+            return path_to_audio
+
+        self._write_mono(path_to_audio, output_path)
+        return output_path
+
+    def _is_speech_dominant(self, path_to_audio: str, frame_ms: int = 30) -> bool:
+        """
+        Cheap SNR heuristic for dialogue-only audio. Speech leaves near-silent pauses between
+        phrases, while music and effects keep the energy floor up, so a large gap between the
+        loud frames and the quiet frames means there is little background to separate.
+        Digital silence is left out, otherwise any file with enough of it would look speech-dominant.
+        """
+
+        # Read through the wav cache, when separation is skipped the VAD pass reuses these samples
+        audio, sr = self._load_wav(path_to_audio)
+        if audio.ndim > 1:
+            audio = audio.mean(axis=1)
+
+        frame_len = int(sr * frame_ms / 1000)
+        n_frames = len(audio) // frame_len
+        frames = audio[:n_frames * frame_len].reshape(n_frames, frame_len)
+        frame_rms = np.sqrt(np.mean(frames ** 2, axis=1))
 
-        wav, sr = soundfile.read(path_to_audio)
+        active_rms = frame_rms[frame_rms > SILENCE_RMS]
+        if active_rms.size == 0:
+            # Nothing but silence, there's no signal to judge so leave it to the separator
+            return False
+
+        noise_floor, peak = np.percentile(active_rms, [10, 95])
+
+        snr_db = 20 * np.log10(peak / noise_floor)
+        print(f"Estimated SNR: {snr_db:.1f} dB")
+        return snr_db > SPEECH_DOMINANCE_SNR_DB
+
+    def _write_mono(self, path_to_audio: str, output_path: str, blocksize: int = 1 << 16):
+        """Copies an audio file as mono, one block at a time so memory stays bounded."""
+
+        samplerate = soundfile.info(path_to_audio).samplerate
+
+        with soundfile.SoundFile(output_path, "w", samplerate=samplerate, channels=1) as out:
+            for block in soundfile.blocks(path_to_audio, blocksize=blocksize, dtype='float32', always_2d=True):
+                out.write(block.mean(axis=1))
+
+    def _downmix_with_ffmpeg(self, path_to_audio: str):
+        """Downmixes an audio file to 16 kHz mono in place."""
+
+        tmp_path = os.path.splitext(path_to_audio)[0] + "_mono.wav"
+        subprocess.run([
+            "ffmpeg",
+            "-y",
+            "-i", path_to_audio,
+            "-ac", "1",
+            "-ar", "16000",
+            tmp_path
+        ], check=True)
+        os.replace(tmp_path, path_to_audio)
+
+    def get_audio_vad_metadata(self, path_to_audio: str, start_ms: int = 0, end_ms: int = float('inf'),
+                               speech_pad_ms: int = SPEECH_PAD_MS) -> list[dict[str, Any]]:
+        """Creates metadata for start and end times of voices, padding each by speech_pad_ms."""
+
+        wav, sr = self._load_wav(path_to_audio)
 
         total_duration_ms = (len(wav) / sr) * 1000
         if end_ms == float('inf') or end_ms is None:
@@ -77,9 +220,51 @@ class VoiceDetector:
         
         segment_audio = wav[start_sample:end_sample]
 
-        return self._run_vad(segment_audio)
+        return self._run_vad_on_array(segment_audio, sr, speech_pad_ms=speech_pad_ms)
+
+    def pad_speech_segments(self, speech_segments, duration_sec: float,
+                            speech_pad_ms: int = SPEECH_PAD_MS) -> list[dict[str, Any]]:
+        """
+        Pads unpadded VAD segments the same way Silero's speech_pad_ms does, so a single
+        VAD pass with speech_pad_ms=0 gives both the padded and the exact speech boundaries.
+        """
+        if not speech_segments:
+            return []
+
+        pad = speech_pad_ms / 1000
+        starts = np.fromiter((seg["start"] for seg in speech_segments), dtype=np.float64, count=len(speech_segments))
+        ends = np.fromiter((seg["end"] for seg in speech_segments), dtype=np.float64, count=len(speech_segments))
+
+        # Silences shorter than two pads are split evenly between the neighbouring segments
+        gaps = starts[1:] - ends[:-1]
+        shifts = np.where(gaps < 2 * pad, gaps / 2, pad)
+        ends[:-1] += shifts
+        starts[1:] -= shifts
+
+        starts[0] = max(0.0, starts[0] - pad)
+        ends[-1] = min(duration_sec, ends[-1] + pad)
+
+        return [{"start": start, "end": end} for start, end in zip(starts.tolist(), ends.tolist())]
+
+    def _load_wav(self, path_to_audio: str):
+        """Reads an audio file, reusing the decoded samples while the file is unchanged."""
+
+        key = (path_to_audio, os.path.getmtime(path_to_audio))
+        cached = self._wav_cache.get(key)
+        if cached is None:
+            # float32 is what Silero takes and halves the memory of soundfile's float64 default
+            cached = soundfile.read(path_to_audio, dtype='float32')
+            # Only keep the latest file around, older entries would just pin memory
+            self._wav_cache = {key: cached}
+
+        return cached
     
-    def _run_vad(self, audio, threshold=0.9, min_speech_ms=300, min_silence_ms=500, speech_pad_ms=1000) -> list[dict[str, Any]]:
+    def release_wav(self):
+        """Drops the cached decoded audio, so a long-lived detector doesn't pin the last file in memory."""
+
+        self._wav_cache = {}
+
+    def _run_vad_on_array(self, audio, sr=16000, threshold=0.9, min_speech_ms=300, min_silence_ms=500, speech_pad_ms=SPEECH_PAD_MS) -> list[dict[str, Any]]:
         """
         Core VAD function that runs on audio tensor/array.
 
@@ -94,28 +279,22 @@ class VoiceDetector:
         Returns:
             List of dicts with 'start' and 'end' in seconds
         """
-        vad_model, vad_utils = torch.hub.load(
-            repo_or_dir='snakers4/silero-vad',
-            model='silero_vad',
-            force_reload=False,
-            trust_repo=True
-        )
-
-        get_speech_timestamps = vad_utils[0]
-
         if isinstance(audio, torch.Tensor):
             wav = audio
         else:
+            # Shares memory with float32 input, only other dtypes are converted
             wav = torch.from_numpy(audio).float()
+        wav = wav.to(VAD_DEVICE)
 
-        vad_result = get_speech_timestamps(
-            wav,
-            vad_model,
-            sampling_rate=16000,
-            threshold=threshold,
-            min_speech_duration_ms=min_speech_ms,
-            min_silence_duration_ms=min_silence_ms,
-            speech_pad_ms=speech_pad_ms
-        )
+        with self._vad_lock, torch.inference_mode():
+            vad_result = self.get_speech_timestamps(
+                wav,
+                self.vad_model,
+                sampling_rate=sr,
+                threshold=threshold,
+                min_speech_duration_ms=min_speech_ms,
+                min_silence_duration_ms=min_silence_ms,
+                speech_pad_ms=speech_pad_ms
+            )
 
-        return [{"start": x["start"] / 16000, "end": x["end"] / 16000} for x in vad_result]
\ No newline at end of file
+        return [{"start": x["start"] / sr, "end": x["end"] / sr} for x in vad_result]